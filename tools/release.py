@@ -5,33 +5,30 @@ import tomli
 import tomli_w
 
 def parse_toml(path):
-    with open(path, "r") as fd:
-        content = fd.read()
-        tomli_dict = tomli.loads(content)
-        return tomli_dict
+    with open(path, "rb") as fd:
+        return tomli.load(fd)
 
 
-def parse_pool():
-    tomls = []
-    for subdir in os.listdir("."):
-        if os.path.isdir(subdir):
-            target = subdir  + "/Cargo.toml"
+def toml_targets():
+    # (dir name, Cargo.toml path) of each workspace crate
+    targets = []
+    for entry in os.scandir("."):
+        if entry.is_dir():
+            target = os.path.join(entry.name, "Cargo.toml")
             if os.path.exists(target):
-                tomls.append(target)
-    
+                targets.append((entry.name, target))
+    return targets
+
+def parse_pool(targets):
     content = {}
-    for toml in tomls:
-        key = toml.split("/")[0] # dir name
-        content[key] = parse_toml(toml)
+    for (subdir, toml) in targets:
+        content[subdir] = parse_toml(toml)
     return content
 
-def update_pool(content):
-    for subdir in os.listdir("."):
-        if os.path.isdir(subdir):
-            target = subdir + "/Cargo.toml"
-            if os.path.exists(target):
-                with open(target, "w") as fd:
-                    fd.write(tomli_w.dumps(content[subdir]))
+def update_pool(targets, content):
+    for (subdir, target) in targets:
+        with open(target, "wb") as fd:
+            tomli_w.dump(content[subdir], fd)
 
 def replace_local_referencing(content):
     latest = {}
@@ -50,9 +47,10 @@ def replace_local_referencing(content):
 
 
 def main(release=None):
-    content = parse_pool()
+    targets = toml_targets()
+    content = parse_pool(targets)
     replace_local_referencing(content)
-    update_pool(content)
+    update_pool(targets, content)
 
 if __name__ == "__main__":
     main()
@@ -8,12 +8,12 @@
 #######################################################
 import os
 import sys
-import math
+import json
 import xarray
 import numpy as np
 import georinex as gr
 from gnss_lib_py import ecef_to_el_az
-from datetime import datetime, timedelta
+from concurrent.futures import ProcessPoolExecutor
 
 gr_kepler_fields = [
     "GPSWeek",
@@ -43,84 +43,59 @@ def is_gr_kepler_key(key):
 def is_gr_perturb_key(key):
     return key in gr_perturb_keys
 
-def sv_is_glonass(sv):
-    return sv[0] == 'R'
+# ground position used for all NAV files
+ref_position = (3628427.9118, 562059.0936, 5197872.2150)
 
-def sv_is_galileo(sv):
-    return sv[0] == 'E'
-
-def sv_is_gps(sv):
-    return sv[0] == 'G'
-
-def sv_is_beidou(sv):
-    return sv[0] == 'C'
-
-def sv_is_sbas(sv):
-    return sv[0] == 'S'
+# supported constellations.
+# GLO, SBAS: not supported yet
+_CONSTELL = {
+    'G': "GPS",
+    'E': "GAL",
+    'C': "BDT",
+    'J': "QZSS",
+}
 
 def sv_to_constell(sv):
-    if sv[0] == 'G':
-        return "GPS"
-    elif sv[0] == 'E':
-        return "GAL"
-    elif sv[0] == 'C':
-        return "BDT"
-    elif sv[0] == 'J':
-        return "QZSS"
-    else:
-        return None
-
-def timescale_t0(sv):
-    if sv_is_gps(sv):
-        return datetime(1980, 1, 6)
-    elif sv_is_beidou(sv):
-        return datetime(1980, 1, 6) # TODO
-    elif sv_is_galileo(sv):
-        return datetime(1980, 1, 6) # TODO
-    elif sv_is_qzss(sv):
-        return datetime(1980, 1, 6)
-    else:
-        return None #will not happen
+    return _CONSTELL.get(sv[0])
 
 def form_entry(fd, epoch, sv, ref_pos, ecef, elev, azi, kepler):
-    fd.write("{\n")
-    fd.write("  \"epoch\": \"{} UTC\",\n".format(epoch))
-    fd.write("  \"sv\": {\n")
-    fd.write("    \"prn\": {},\n".format(int(sv[1:])))
-    fd.write("    \"constellation\": \"{}\"\n".format(sv_to_constell(sv[0])))
-    fd.write("  },\n")
-    fd.write("  \"week\": {},\n".format(int(kepler_weekcounter(kepler))))
-    fd.write("  \"ref_pos\": [{},{},{}],\n".format(ref_pos[0], ref_pos[1], ref_pos[2]))
-    fd.write("  \"ecef\": [{},{},{}],\n".format(ecef[0], ecef[1], ecef[2]))
-    fd.write("  \"elev\": {},\n".format(str(elev[0])))
-    fd.write("  \"azi\": {},\n".format(str(azi[0])))
-    fd.write("  \"kepler\": {\n")
-    fd.write("    \"a\": {},\n".format(math.pow(kepler["sqrtA"], 2)))
-    fd.write("    \"e\": {},\n".format(kepler["Eccentricity"]))
-    fd.write("    \"i_0\": {},\n".format(kepler["Io"]))
-    fd.write("    \"omega_0\": {},\n".format(kepler["Omega0"]))
-    fd.write("    \"m_0\": {},\n".format(kepler["M0"]))
-    fd.write("    \"omega\": {},\n".format(kepler["omega"]))
-    fd.write("    \"toe\": {}\n".format(kepler["Toe"]))
-    fd.write("  },\n")
-    fd.write("  \"perturbations\": {\n")
-    fd.write("    \"dn\": {},\n".format(math.pow(kepler["DeltaN"], 2)))
-    fd.write("    \"i_dot\": {},\n".format(kepler["IDOT"]))
-    fd.write("    \"omega_dot\": {},\n".format(kepler["OmegaDot"]))
-    fd.write("    \"cus\": {},\n".format(kepler["Cus"]))
-    fd.write("    \"cuc\": {},\n".format(kepler["Cuc"]))
-    fd.write("    \"cis\": {},\n".format(kepler["Cis"]))
-    fd.write("    \"cic\": {},\n".format(kepler["Cic"]))
-    fd.write("    \"crs\": {},\n".format(kepler["Crs"]))
-    fd.write("    \"crc\": {}\n".format(kepler["Crc"]))
-    fd.write("  }\n")
-    fd.write("}")
+    entry = {
+        "epoch": "{} UTC".format(epoch),
+        "sv": {
+            "prn": int(sv[1:]),
+            "constellation": sv_to_constell(sv),
+        },
+        "week": int(kepler_weekcounter(kepler)),
+        "ref_pos": [float(x) for x in ref_pos],
+        "ecef": [float(x) for x in ecef],
+        "elev": float(elev[0]),
+        "azi": float(azi[0]),
+        "kepler": {
+            "a": float(kepler["sqrtA"] * kepler["sqrtA"]),
+            "e": float(kepler["Eccentricity"]),
+            "i_0": float(kepler["Io"]),
+            "omega_0": float(kepler["Omega0"]),
+            "m_0": float(kepler["M0"]),
+            "omega": float(kepler["omega"]),
+            "toe": float(kepler["Toe"]),
+        },
+        "perturbations": {
+            "dn": float(kepler["DeltaN"] * kepler["DeltaN"]),
+            "i_dot": float(kepler["IDOT"]),
+            "omega_dot": float(kepler["OmegaDot"]),
+            "cus": float(kepler["Cus"]),
+            "cuc": float(kepler["Cuc"]),
+            "cis": float(kepler["Cis"]),
+            "cic": float(kepler["Cic"]),
+            "crs": float(kepler["Crs"]),
+            "crc": float(kepler["Crc"]),
+        },
+    }
+    fd.write(json.dumps(entry, separators=(",", ":"), allow_nan=False))
 
 def kepler_hasnan(kepler):
-    for key in kepler.keys():
-        if math.isnan(kepler[key]):
-            return True
-    return False
+    # kepler: one row per (time, sv), one column per field
+    return kepler.isna().any(axis=1)
 
 def kepler_weekcounter(kepler):
     for k in ["GPSWeek", "GALWeek", "BDTWeek"]:
@@ -128,20 +103,120 @@ def kepler_weekcounter(kepler):
             return int(kepler[k])
     return None
 
-def kepler_has_weekcounter(kepler):
-    return kepler_weekcounter(kepler) is not None
-
-def kepler_ready(kepler):
-    if kepler_hasnan(kepler):
-        return False
-    if not(kepler_has_weekcounter(kepler)):
-        return False
+def kepler_defined(fields):
+    # fields: kepler fields defined in this file
+    # returns True if rows may be ready at all
+    if not any("Week" in key for key in fields):
+        return False # no week counter
     for key in gr_kepler_fields:
         if not "Week" in key: # already tested
-            if not(key in kepler):
+            if not(key in fields):
                 return False # key is missing
     return True
 
+def kepler_ready(kepler):
+    # kepler: one row per (time, sv), one column per field,
+    # fields being kepler_defined()
+    # returns readiness mask of each row
+    return ~kepler_hasnan(kepler).values
+
+def load_nav(nav_path, cache_path):
+    # parsed NAV content is cached as netCDF,
+    # only parsed again when NAV file is more recent.
+    # Cache is best effort: we fall back to parsing on any cache error
+    if os.path.exists(cache_path):
+        if os.path.getmtime(cache_path) >= os.path.getmtime(nav_path):
+            try:
+                return xarray.load_dataset(cache_path)
+            except Exception:
+                pass # corrupt or unreadable cache: parse again
+    nav = gr.load(nav_path)
+    # written aside then moved into place,
+    # so an interrupted run never leaves a truncated cache behind
+    tmp_path = "{}.{}.tmp".format(cache_path, os.getpid())
+    try:
+        os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+        nav.to_netcdf(tmp_path)
+        os.replace(tmp_path, cache_path)
+    except Exception: # no netCDF backend installed, I/O error..
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+    return nav
+
+def process_nav_file(nav_path, rev, base_dir, debug=False):
+    # resolves all (Epoch, Sv) of given NAV file,
+    # and generates its testbench file
+    if (debug):
+        print("FILE: ", nav_path)
+
+    fp = os.path.basename(nav_path)
+    nav = load_nav(nav_path, base_dir + "/.gr_cache/{}/{}.nc".format(rev, fp))
+
+    fields = [field for field in gr_kepler_fields if field in nav]
+    txt_path = base_dir + "/gr/{}/{}.txt".format(rev, fp)
+
+    if not kepler_defined(fields):
+        # no Kepler definition (GLO/SBAS only file..):
+        # nothing to resolve, testbench file is empty
+        open(txt_path, "w").close()
+        return
+
+    # one row per (time, sv), one column per kepler field
+    kepler = nav[fields].to_dataframe(dim_order=["time", "sv"])
+    vehicles = kepler.index.get_level_values("sv")
+
+    # GNSS: not supported yet or unknown definition
+    keep = vehicles.str[0].isin(list(_CONSTELL.keys()))
+    if debug:
+        print("Not supported yet:", vehicles[~keep].unique().values)
+
+    ready = kepler[keep & kepler_ready(kepler)]
+
+    ecef = np.full((len(ready), 3), np.nan)
+    elev = np.full(len(ready), np.nan)
+    azim = np.full(len(ready), np.nan)
+
+    for (sv, indexes) in ready.groupby(level="sv").indices.items():
+        if debug:
+            print("sv: ", sv, "kepler ready", len(indexes))
+
+        # kepler struct fully defined:
+        # we have everything to determine
+        # and space vehicle vectors, and elev° and azim °
+        # for this SV, across all of its ready epochs at once.
+        # keplerian2ecef works on a single SV time serie;
+        # the nav "time" coordinate is already expressed in GNSS time.
+        rows = ready.iloc[indexes].droplevel("sv")
+        struct = xarray.Dataset.from_dataframe(rows)
+        struct.attrs["svtype"] = sv[0]
+
+        (x, y, z) = gr.keplerian2ecef(struct)
+        shape3d = np.asarray([x, y, z])
+        ecef[indexes] = shape3d.T
+        (elev[indexes], azim[indexes]) = ecef_to_el_az(np.asarray(ref_position), shape3d)
+
+    # (n_rows, n_fields) numpy view: no per-row pandas accessor
+    stack = ready.to_numpy()
+    # formatted once for the whole file
+    epochs = np.datetime_as_string(ready.index.get_level_values("time").values, unit="ns")
+    vehicles = ready.index.get_level_values("sv").values
+
+    with open(txt_path, "w") as fd:
+        for k in range(len(ready)):
+            if k > 0:
+                fd.write(",\n")
+            form_entry(
+                fd,
+                epochs[k],
+                vehicles[k],
+                ref_position,
+                ecef[k],
+                elev[k:k+1],
+                azim[k:k+1],
+                dict(zip(fields, stack[k])))
+        if len(ready) > 0:
+            fd.write("\n")
+
 def main(argv):
     if len(argv) == 0:
         print("[test_pool_dir]")
@@ -150,101 +225,24 @@ def main(argv):
     base_dir = argv[0]
     debug = len(argv) > 1
 
-    supported_rev = ["V2", "V3"]
+    supported_rev = {"V2", "V3"}
 
-    for rev in os.listdir(base_dir + "/NAV"):
-        if not(rev in supported_rev):
+    tasks = []
+    for rev in os.scandir(base_dir + "/NAV"):
+        if not(rev.name in supported_rev) or not rev.is_dir():
             continue
         
-        for fp in os.listdir(base_dir + "/NAV/{}".format(rev)):  
-            nav_path = base_dir + "/NAV/{}/{}".format(rev, fp)
-            if (debug):
-                print("FILE: ", nav_path) 
-
-            nav = gr.load(nav_path) 
-
-            ref_position = (3628427.9118, 562059.0936, 5197872.2150)
-
-            txt_path = base_dir + "/gr/{}/{}.txt".format(rev, fp)
-            with open(txt_path, "w") as fd:
-                epochs = nav["time"].values
-                vehicles = nav["sv"].values
-                for epoch in epochs :
-                    data = nav.sel(time=epoch)
-                    for sv in vehicles:
-                        if sv_is_glonass(sv):
-                            if debug:
-                                print("Glonass: not supported yet")
-                            continue # GLO: NOT YET
-                        if sv_is_sbas(sv):
-                            if debug:
-                                print("Glonass: not supported yet")
-                            continue # GEO: NOT YET
-                        if sv_to_constell(sv) is None:
-                            if debug:
-                                print("Unknown constellation :", sv)
-                            continue # GNSS: not supported yet or unknown definition
-
-                        sv_data = data.sel(sv=sv)
-
-                        kepler = {}
-                        for field in gr_kepler_fields:
-                            # week counter special case
-                            if field in sv_data:
-                                kepler[field] = sv_data.variables[field].values
-
-                        if debug:
-                            print("sv: ", sv, "kepler ready", kepler_ready(kepler)) 
-
-                        if kepler_ready(kepler):
-                            # kepler struct fully defined:
-                            # we have everything to determine
-                            # and space vehicle vectors, and elev° and azim °
-                            weeks = kepler_weekcounter(kepler)
-
-                            tgnss = timescale_t0(sv)
-                            tgnss += timedelta(weeks=weeks)
-
-                            # need offset within that week
-                            week_offset = epoch.astype("datetime64[us]").astype(datetime)
-                            week_offset -= timescale_t0(sv)
-                            week_offset -= timedelta(weeks=weeks)
-                            tgnss += week_offset 
-
-                            (xref, yref, zref) = ref_position 
-                            struct = xarray.Dataset(
-                                kepler,
-                                attrs={
-                                    "svtype": sv[0], 
-                                    # "xref": xref, 
-                                    # "yref": yref,
-                                    # "zref": zref,
-                                },
-                                coords={"time": [tgnss]},
-                            )
-    
-                            expected_ecef = list(gr.keplerian2ecef(struct))
-                            expected_ecef = (expected_ecef[0][0], expected_ecef[1][0], expected_ecef[2][0])
-
-                            shape3d = np.asarray([[expected_ecef[0]], [expected_ecef[1]], [expected_ecef[2]]])
-                            (elev, azim) = ecef_to_el_az(np.asarray(ref_position), shape3d)
-
-                            form_entry(
-                                fd, 
-                                epoch, 
-                                sv,
-                                ref_position,
-                                expected_ecef,
-                                elev,
-                                azim,
-                                kepler)
-                            
-                            if sv == vehicles[-1]:
-                                if epoch == epochs[-1]:
-                                    fd.write("\n")
-                                else:
-                                    fd.write(",\n")
-                            fd.write(",\n")
+        for fp in os.scandir(rev.path):
+            if not fp.is_file():
+                continue
+            tasks.append((fp.path, rev.name, base_dir, debug))
+
+    if len(tasks) == 0:
+        return 0
+
+    # NAV files are independent from one another
+    with ProcessPoolExecutor() as executor:
+        list(executor.map(process_nav_file, *zip(*tasks)))
     return 0
 
 if __name__ == "__main__":